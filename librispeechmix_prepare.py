@@ -5,11 +5,23 @@ Authors
 """
 
 import copy
+import functools
 import json
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
 from collections import defaultdict
-from typing import List, Optional, Sequence, Union
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 __all__ = ["prepare_librispeechmix"]
@@ -31,6 +43,12 @@ _DEFAULT_SPLITS = (
     "test-clean-3mix",
 )
 
+# Maps split name prefixes to the names of the output data manifest files
+_GROUP_NAMES = {"train": "train", "dev": "dev", "test": "test"}
+
+# Placeholder prefix for the audio paths, replaced with the data folder at loading time
+_DATA_ROOT_PREFIX = os.path.join("{DATA_ROOT}", "")
+
 
 def prepare_librispeechmix(
     data_folder: "str",
@@ -41,8 +59,11 @@ def prepare_librispeechmix(
     trim_nontarget: "Optional[float]" = None,
     suppress_delay: "Optional[bool]" = None,
     overlap_ratio: "Optional[float]" = None,
+    manifest_format: "str" = "jsonl",
+    num_workers: "Optional[int]" = 1,
+    merge_splits: "bool" = True,
 ) -> "None":
-    """Prepare data manifest JSON files for LibriSpeechMix dataset
+    """Prepare data manifest JSON(L) files for LibriSpeechMix dataset
     (see https://github.com/NaoyukiKanda/LibriSpeechMix).
 
     Arguments
@@ -51,11 +72,11 @@ def prepare_librispeechmix(
         The path to the dataset folder (i.e. a folder containing the standard
         LibriSpeech folders + the LibriSpeechMix JSONL annotation files).
     save_folder:
-        The path to the folder where the data manifest JSON files will be stored.
+        The path to the folder where the data manifest JSON(L) files will be stored.
         Default to `data_folder`.
     splits:
         The dataset splits to load.
-        Splits with the same prefix are merged into a single JSON file
+        Splits with the same prefix are merged into a single JSON(L) file
         (e.g. "dev-clean-1mix" and "dev-clean-2mix").
         Default to all the available splits.
     num_targets:
@@ -81,6 +102,23 @@ def prepare_librispeechmix(
         that a new mixture is created for each target utterance.
         Must be None if `suppress_delay` is set.
         Default the values specifies in the annotation file for each mixture.
+    manifest_format:
+        The data manifest file format, either "jsonl" (one `{ID: entry}` JSON
+        object per line, which can be loaded incrementally) or "json" (legacy,
+        a single JSON object that maps IDs to entries).
+        Default to "jsonl".
+    num_workers:
+        The number of worker processes used to process the splits in parallel.
+        If at most 1, the splits are processed serially in the calling process.
+        If None, one worker per split is used (at most the number of CPUs).
+        Each worker re-imports the calling script's modules, which usually
+        costs more than it saves unless the splits are large.
+        Default to 1.
+    merge_splits:
+        True to merge splits with the same prefix into a single JSON(L) file
+        (e.g. "dev.jsonl"), False to write a separate JSON(L) file for each
+        split (e.g. "dev-clean-1mix.jsonl" and "dev-clean-2mix.jsonl").
+        Default to True.
 
     Raises
     ------
@@ -110,120 +148,259 @@ def prepare_librispeechmix(
             raise ValueError(
                 f"`overlap_ratio` ({overlap_ratio}) must be in the interval [0, 1]"
             )
+    if manifest_format not in ["json", "jsonl"]:
+        raise ValueError(
+            f'`manifest_format` ({manifest_format}) must be either "json" or "jsonl"'
+        )
+
+    if not merge_splits and os.path.realpath(save_folder) == os.path.realpath(
+        data_folder
+    ):
+        raise ValueError(
+            f"`save_folder` ({save_folder}) must differ from `data_folder` "
+            f"if `merge_splits` is False"
+        )
 
     # Grouping
     groups = defaultdict(list)
     for split in splits:
-        if split.startswith("train"):
-            groups["train"].append(split)
-        elif split.startswith("dev"):
-            groups["dev"].append(split)
-        elif split.startswith("test"):
-            groups["test"].append(split)
-        else:
+        group_name = next(
+            (g for prefix, g in _GROUP_NAMES.items() if split.startswith(prefix)),
+            None,
+        )
+        if group_name is None:
             raise ValueError(
                 f'`split` ({split}) must start with either "train", "dev" or "test"'
             )
+        if not merge_splits:
+            group_name = split
+        groups[group_name].append(split)
 
-    # Write output JSON for each group
-    for group_name, group in groups.items():
-        _LOGGER.info(
-            "----------------------------------------------------------------------",
+    # Check inputs before writing anything
+    for split in splits:
+        input_jsonl = os.path.join(data_folder, f"{split}.jsonl")
+        if not os.path.exists(input_jsonl):
+            raise RuntimeError(f'"{input_jsonl}" not found')
+
+    # Process the splits in parallel, each worker streams its output entries
+    # to a temporary file to avoid buffering the whole manifest in memory.
+    # Workers are spawned rather than forked, since this may be called from a
+    # process that has already initialized CUDA (e.g. for testing after training)
+    if num_workers is None:
+        num_workers = min(len(splits), os.cpu_count() or 1)
+    executor = None
+    if num_workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
         )
+    with tempfile.TemporaryDirectory(dir=save_folder) as tmp_folder, (
+        executor or nullcontext()
+    ):
+        # Maps each split to a callable returning its output part,
+        # run serially in this process if there is no executor
+        results = {}
+        for split in splits:
+            if split in results:
+                continue
+            args = (
+                os.path.join(data_folder, f"{split}.jsonl"),
+                os.path.join(tmp_folder, f"{split}.{manifest_format}"),
+                manifest_format,
+                num_targets,
+                num_enrolls,
+                trim_nontarget,
+                suppress_delay,
+                overlap_ratio,
+            )
+            if executor is None:
+                results[split] = functools.partial(_process_split, *args)
+            else:
+                results[split] = executor.submit(_process_split, *args).result
 
-        output_entries = {}
-        for split in group:
-            _LOGGER.info(f"Split: {split}")
-
-            # Read input JSONL
-            input_jsonl = os.path.join(data_folder, f"{split}.jsonl")
-            if not os.path.exists(input_jsonl):
-                raise RuntimeError(f'"{input_jsonl}" not found')
-            with open(input_jsonl, "r", encoding="utf-8") as fr:
-                for input_line in fr:
-                    input_entry = json.loads(input_line)
-                    ID = input_entry["id"]
-                    wavs = input_entry["wavs"]
-                    durations = copy.deepcopy(input_entry["durations"])
-                    speaker_profile = input_entry["speaker_profile"]
-                    texts = input_entry["texts"]
-                    speaker_profile_index = input_entry["speaker_profile_index"]
-                    speakers = input_entry["speakers"]
-                    genders = input_entry["genders"]
-
-                    if isinstance(num_targets, (int, float)):
-                        target_speaker_idxes = list(range(int(num_targets)))
-                    elif isinstance(num_targets, list):
-                        target_speaker_idxes = num_targets
-                    elif num_targets == "min":
-                        min_duration = min(durations)
-                        min_idx = durations.index(min_duration)
-                        target_speaker_idxes = [min_idx]
-                    elif num_targets == "max":
-                        max_duration = max(durations)
-                        max_idx = durations.index(max_duration)
-                        target_speaker_idxes = [max_idx]
-                    elif num_targets is None:
-                        target_speaker_idxes = list(range(len(texts)))
-                    else:
-                        raise NotImplementedError
-
-                    wavs = [os.path.join("{DATA_ROOT}", wav) for wav in wavs]
-                    for target_speaker_idx in target_speaker_idxes:
-                        text = texts[target_speaker_idx]
-                        idx = speaker_profile_index[target_speaker_idx]
-                        ID_text = f"{ID}_text-{target_speaker_idx}"
-
-                        # Read here to not overwrite
-                        delays = copy.deepcopy(input_entry["delays"])
-
-                        if suppress_delay:
-                            delays = [0.0 for _ in delays]
-
-                        if overlap_ratio is not None:
-                            target_duration = durations[target_speaker_idx]
-                            overlap_start = (1 - overlap_ratio) * target_duration
-                            delays = [overlap_start] * len(wavs)
-                            delays[target_speaker_idx] = 0
-
-                        start = 0.0
-                        duration = max([d + x for d, x in zip(delays, durations)])
-                        max_duration = copy.deepcopy(duration)
-                        if trim_nontarget is not None:
-                            start = delays[target_speaker_idx]
-                            duration = durations[target_speaker_idx]
-                            new_start = max(0.0, start - trim_nontarget)
-                            duration += start - new_start
-                            duration = min(
-                                duration + trim_nontarget, max_duration - new_start
-                            )
-                            start = new_start
-
-                        enroll_wavs = speaker_profile[idx]
-                        for enroll_wav in enroll_wavs[:num_enrolls]:
-                            ID_enroll = f"{ID_text}_{enroll_wav}"
-                            enroll_wav = os.path.join("{DATA_ROOT}", enroll_wav)
-                            output_entry = {
-                                "wavs": wavs,
-                                "enroll_wav": enroll_wav,
-                                "delays": delays,
-                                "start": start,
-                                "duration": duration,
-                                "durations": durations,
-                                "target_speaker_idx": target_speaker_idx,
-                                "wrd": text,
-                                "speakers": speakers,
-                                "genders": genders,
-                            }
-                            output_entries[ID_enroll] = output_entry
-
-        # Write output JSON
-        output_json = os.path.join(save_folder, f"{group_name}.json")
-        _LOGGER.info(f"Writing {output_json}...")
-        with open(output_json, "w", encoding="utf-8") as fw:
-            json.dump(output_entries, fw, ensure_ascii=False, indent=4)
+        # Write output JSON(L) for each group
+        for group_name, group in groups.items():
+            _LOGGER.info(
+                "----------------------------------------------------------------------",
+            )
+            output_manifest = os.path.join(
+                save_folder, f"{group_name}.{manifest_format}"
+            )
+            _LOGGER.info(f"Writing {output_manifest}...")
+            with open(output_manifest, "wb") as fw:
+                if manifest_format == "json":
+                    fw.write(b"{")
+                for split in group:
+                    _LOGGER.info(f"Split: {split}")
+                    output_part = results[split]()
+                    with open(output_part, "rb") as fr:
+                        if manifest_format == "json" and fw.tell() == 1:
+                            # Drop the separator preceding the first entry
+                            fr.read(1)
+                        shutil.copyfileobj(fr, fw)
+                if manifest_format == "json":
+                    fw.write(b"\n}\n")
 
     _LOGGER.info(
         "----------------------------------------------------------------------",
     )
     _LOGGER.info("Done!")
+
+
+def _process_split(
+    input_jsonl: "str",
+    output_part: "str",
+    manifest_format: "str",
+    num_targets: "Optional[Union[int, List[int]], str]" = None,
+    num_enrolls: "Optional[int]" = None,
+    trim_nontarget: "Optional[float]" = None,
+    suppress_delay: "Optional[bool]" = None,
+    overlap_ratio: "Optional[float]" = None,
+) -> "str":
+    """Convert a LibriSpeechMix JSONL annotation file into data manifest entries.
+
+    Arguments
+    ---------
+    input_jsonl:
+        The path to the LibriSpeechMix JSONL annotation file.
+    output_part:
+        The path to the file where the data manifest entries will be written.
+        If `manifest_format` is "json", each entry is preceded by a separator.
+    manifest_format:
+        The data manifest file format, either "jsonl" or "json".
+    num_targets:
+        See `prepare_librispeechmix`.
+    num_enrolls:
+        See `prepare_librispeechmix`.
+    trim_nontarget:
+        See `prepare_librispeechmix`.
+    suppress_delay:
+        See `prepare_librispeechmix`.
+    overlap_ratio:
+        See `prepare_librispeechmix`.
+
+    Returns
+    -------
+        The path to the file where the data manifest entries were written.
+
+    """
+    # Encoded enrollment utterance paths (speaker profiles are shared across mixtures)
+    enroll_wav_jsons = {}
+
+    with open(input_jsonl, "rb") as fr:
+        # Read the whole file at once, much faster than iterating over lines
+        input_lines = fr.read().splitlines()
+    with open(output_part, "wb") as fw:
+        for input_line in input_lines:
+            if not input_line:
+                continue
+            input_entry = _json_loads(input_line)
+            ID = input_entry["id"]
+            wavs = input_entry["wavs"]
+            durations = copy.deepcopy(input_entry["durations"])
+            speaker_profile = input_entry["speaker_profile"]
+            texts = input_entry["texts"]
+            speaker_profile_index = input_entry["speaker_profile_index"]
+            speakers = input_entry["speakers"]
+            genders = input_entry["genders"]
+
+            if isinstance(num_targets, (int, float)):
+                target_speaker_idxes = list(range(int(num_targets)))
+            elif isinstance(num_targets, list):
+                target_speaker_idxes = num_targets
+            elif num_targets == "min":
+                min_duration = min(durations)
+                min_idx = durations.index(min_duration)
+                target_speaker_idxes = [min_idx]
+            elif num_targets == "max":
+                max_duration = max(durations)
+                max_idx = durations.index(max_duration)
+                target_speaker_idxes = [max_idx]
+            elif num_targets is None:
+                target_speaker_idxes = list(range(len(texts)))
+            else:
+                raise NotImplementedError
+
+            wavs = [_DATA_ROOT_PREFIX + wav for wav in wavs]
+            for target_speaker_idx in target_speaker_idxes:
+                text = texts[target_speaker_idx]
+                idx = speaker_profile_index[target_speaker_idx]
+                ID_text_prefix = f"{ID}_text-{target_speaker_idx}_"
+
+                # Read here to not overwrite
+                delays = copy.deepcopy(input_entry["delays"])
+
+                if suppress_delay:
+                    delays = [0.0 for _ in delays]
+
+                if overlap_ratio is not None:
+                    target_duration = durations[target_speaker_idx]
+                    overlap_start = (1 - overlap_ratio) * target_duration
+                    delays = [overlap_start] * len(wavs)
+                    delays[target_speaker_idx] = 0
+
+                start = 0.0
+                duration = max([d + x for d, x in zip(delays, durations)])
+                max_duration = copy.deepcopy(duration)
+                if trim_nontarget is not None:
+                    start = delays[target_speaker_idx]
+                    duration = durations[target_speaker_idx]
+                    new_start = max(0.0, start - trim_nontarget)
+                    duration += start - new_start
+                    duration = min(duration + trim_nontarget, max_duration - new_start)
+                    start = new_start
+
+                # Fields shared by all the enrollment utterances
+                # of the current target speaker
+                target_entry = {
+                    "wavs": wavs,
+                    "delays": delays,
+                    "start": start,
+                    "duration": duration,
+                    "durations": durations,
+                    "target_speaker_idx": target_speaker_idx,
+                    "wrd": text,
+                    "speakers": speakers,
+                    "genders": genders,
+                }
+
+                # Encode the shared fields only once, the output entries
+                # differ only in the enrollment utterance
+                target_entry_json = b"," + _json_dumps(target_entry)[1:]
+
+                enroll_wavs = speaker_profile[idx][:num_enrolls]
+                for enroll_wav in enroll_wavs:
+                    ID_enroll = ID_text_prefix + enroll_wav
+                    enroll_wav_json = enroll_wav_jsons.get(enroll_wav)
+                    if enroll_wav_json is None:
+                        enroll_wav_json = b'{"enroll_wav":' + _json_dumps(
+                            _DATA_ROOT_PREFIX + enroll_wav
+                        )
+                        enroll_wav_jsons[enroll_wav] = enroll_wav_json
+                    output_entry_json = enroll_wav_json + target_entry_json
+                    if manifest_format == "jsonl":
+                        fw.write(
+                            b"{"
+                            + _json_dumps(ID_enroll)
+                            + b":"
+                            + output_entry_json
+                            + b"}\n"
+                        )
+                    else:
+                        fw.write(
+                            b",\n" + _json_dumps(ID_enroll) + b":" + output_entry_json
+                        )
+
+    return output_part
+
+
+def _json_loads(line: "bytes") -> "Dict":
+    # orjson decodes UTF-8 bytes directly, much faster than the standard library
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def _json_dumps(obj: "Any") -> "bytes":
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
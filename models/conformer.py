@@ -23,6 +23,7 @@ from speechbrain.nnet.normalization import LayerNorm
 from speechbrain.nnet.containers import ModuleList
 from speechbrain.nnet.linear import Linear
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 
 __all__ = ["ConformerEncoder"]
@@ -71,6 +72,9 @@ class ConformerEncoder(nn.Module):
         If -1, inject the speaker embedding before the first layer.
         If a list, inject the speaker embedding after the `i`-th layer,
         for each `i` in `injection_after`.
+    grad_checkpointing : bool, optional
+        True to recompute the activations of each layer during the backward pass
+        instead of storing them (trades compute for memory, training only).
 
     Example
     -------
@@ -104,6 +108,7 @@ class ConformerEncoder(nn.Module):
         causal=False,
         injection_mode: "Optional[str]" = "prod",
         injection_after: "Union[int, List[int]]" = 0,
+        grad_checkpointing: "bool" = False,
     ):
         super().__init__()
         self.input_size = input_size
@@ -123,6 +128,7 @@ class ConformerEncoder(nn.Module):
         self.injection_after = injection_after
         if not isinstance(injection_after, (list, tuple)):
             self.injection_after = [injection_after]
+        self.grad_checkpointing = grad_checkpointing
 
         if positional_encoding_type == "fixed_abs_sine":
             self.positional_encoding = PositionalEncoding(d_model, max_length)
@@ -219,14 +225,27 @@ class ConformerEncoder(nn.Module):
             pos_embs = None
             src += self.positional_encoding(src)  # Add the encodings here
 
+        grad_checkpointing = (
+            self.grad_checkpointing and self.training and torch.is_grad_enabled()
+        )
         attns = []
         for i, layer in enumerate(self.layers):
-            src, attn = layer(
-                src,
-                src_mask=src_mask,
-                src_key_padding_mask=src_key_padding_mask,
-                pos_embs=pos_embs,
-            )
+            if grad_checkpointing:
+                src, attn = checkpoint(
+                    layer,
+                    src,
+                    src_mask,
+                    src_key_padding_mask,
+                    pos_embs,
+                    use_reentrant=False,
+                )
+            else:
+                src, attn = layer(
+                    src,
+                    src_mask=src_mask,
+                    src_key_padding_mask=src_key_padding_mask,
+                    pos_embs=pos_embs,
+                )
             if return_attn:
                 attns.append(attn.detach())
 
@@ -256,8 +275,10 @@ class ConformerEncoder(nn.Module):
             key_padding_mask = None
             if speaker_embs_length is not None:
                 key_padding_mask = ~length_to_mask(
-                    (speaker_embs_length * speaker_embs.shape[-2]).round()
-                ).bool()  # True for masked tokens
+                    (speaker_embs_length * speaker_embs.shape[-2]).round(),
+                    max_len=speaker_embs.shape[-2],
+                    dtype=torch.bool,
+                )  # True for masked tokens
             src, _ = self.speaker_attn(
                 src, speaker_embs, speaker_embs, key_padding_mask=key_padding_mask,
             )
@@ -270,7 +291,10 @@ class ConformerEncoder(nn.Module):
     def _make_masks(self, src, wav_len=None):
         if wav_len is not None:
             abs_len = (wav_len * src.shape[1]).round()
-            src_key_padding_mask = ~length_to_mask(abs_len).bool()
+            # Passing max_len avoids a device-host sync on abs_len.max()
+            src_key_padding_mask = ~length_to_mask(
+                abs_len, max_len=src.shape[1], dtype=torch.bool
+            )
         else:
             src_key_padding_mask = None
 
@@ -57,7 +57,7 @@ def _set_style(style_file_or_name="classic", usetex=False, fontsize=12):
 
 
 def parse_data_manifest(data_manifest: "str") -> "Dict[str, Dict]":
-    """Parse data JSON manifest to extract utterance IDs and
+    """Parse data JSON(L) manifest to extract utterance IDs and
     corresponding feature values.
 
     The following features are available:
@@ -80,13 +80,19 @@ def parse_data_manifest(data_manifest: "str") -> "Dict[str, Dict]":
 
     Examples
     --------
-    >>> features = parse_data_manifest("test.json")
+    >>> features = parse_data_manifest("test.jsonl")
 
     """
     features = defaultdict(dict)
     if data_manifest.endswith(".json"):
         with open(data_manifest, "r", encoding="utf-8") as fr:
             data = json.load(fr)
+    elif data_manifest.endswith(".jsonl"):
+        data = {}
+        with open(data_manifest, "r", encoding="utf-8") as fr:
+            for line in fr:
+                if line.strip():
+                    data.update(json.loads(line))
     for utterance_id, entry in data.items():
         target_speaker_idx = entry["target_speaker_idx"]
         # wav = datum["wavs"][target_speaker_idx]
@@ -219,7 +225,7 @@ def plot_data(
 
     Examples
     --------
-    >>> features = parse_data_manifest("test.json")
+    >>> features = parse_data_manifest("test.jsonl")
     >>> plot_data({x: features[x]["duration"] for x in features}, "test.jpg")
 
     """
@@ -332,7 +338,7 @@ if __name__ == "__main__":
         }
         output_image = (
             args.output_image
-            or args.data_manifest[0].replace(".json", "") + f"_{feature}" + ".jpg"
+            or os.path.splitext(args.data_manifest[0])[0] + f"_{feature}" + ".jpg"
         )
         xlabel = args.xlabel or feature
         ylabel = args.ylabel or "Frequency"
@@ -346,7 +352,7 @@ if __name__ == "__main__":
         }
         output_image = (
             args.output_image
-            or args.data_manifest[0].replace(".json", "")
+            or os.path.splitext(args.data_manifest[0])[0]
             + f"_{feature[0]}_vs_{feature[1]}"
             + ".jpg"
         )
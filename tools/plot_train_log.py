@@ -12,6 +12,8 @@ Authors
 import argparse
 import contextlib
 import os
+import re
+from array import array
 from collections import defaultdict
 from typing import Dict, Optional, Tuple
 
@@ -33,6 +35,9 @@ _EXPECTED_METRICS = [
     "valid WER",
 ]
 
+# Matches "<name>: <value>" pairs separated by ", " or " - "
+_METRIC = re.compile(r"(\w[^:,]*): ([^ ,]+)")
+
 
 @contextlib.contextmanager
 def _set_style(style_file_or_name="classic", usetex=False, fontsize=12):
@@ -85,26 +90,23 @@ def parse_train_log(train_log: "str") -> "Dict[str, ndarray]":
     >>> metrics = parse_train_log("train_log.txt")
 
     """
-    metrics = defaultdict(list)
+    metrics = defaultdict(lambda: array("d"))
     with open(train_log) as f:
         for line in f:
-            line = line.strip().replace(" - ", ", ")
+            line = line.strip()
             if not line:
                 continue
-            tokens = line.split(", ")
-            names, values = zip(*[token.split(": ") for token in tokens])
-            names, values = list(names), list(values)
+            kvs = dict(_METRIC.findall(line))
             for name in _EXPECTED_METRICS:
-                if name not in names:
-                    names.append(name)
-                    values.append("nan")
-            for name, value in zip(names, values):
+                kvs.setdefault(name, "nan")
+            for name, value in kvs.items():
                 try:
                     metrics[name].append(float(value))
-                except Exception:
+                except ValueError:
                     pass
     for name, values in metrics.items():
-        metrics[name] = np.array(values)
+        # Zero-copy view, the accumulator is not modified anymore
+        metrics[name] = np.frombuffer(values, dtype=np.float64)
     return metrics
 
 
@@ -148,6 +150,8 @@ def plot_metrics(
     if os.path.isfile(style_file_or_name):
         style_file_or_name = os.path.realpath(style_file_or_name)
     with _set_style(style_file_or_name, usetex):
+        plt.figure(figsize=figsize)
+
         # Train
         plt.plot(
             metrics["epoch"], metrics["train loss"], marker="o", label="Train loss",
@@ -160,11 +164,13 @@ def plot_metrics(
             marker="X",
             label="Validation loss",
         )
-        for i, value in enumerate(metrics["valid WER"]):
-            if i % 10 == 0:
-                plt.annotate(
-                    f"WER={value}%", (i + 1, metrics["valid loss"][i]),
-                )
+        # Annotate the WER every 10 epochs, skipping epochs without one
+        idxes = np.arange(0, len(metrics["valid WER"]), 10)
+        idxes = idxes[~np.isnan(metrics["valid WER"][idxes])]
+        for i, value in zip(idxes, metrics["valid WER"][idxes]):
+            plt.annotate(
+                f"WER={value}%", (i + 1, metrics["valid loss"][i]),
+            )
 
         # Test
         if "test_loss" in metrics:
@@ -189,7 +195,7 @@ def plot_metrics(
         # ymin, ymax = plt.ylim()
         # yrange = ymax - ymin
         # plt.ylim(ymin - 0.025 * yrange, ymax + 0.025 * yrange)
-        fig.tight_layout()
+        plt.tight_layout()
         plt.savefig(output_image, bbox_inches="tight")
         plt.close()
 
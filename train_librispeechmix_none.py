@@ -14,12 +14,14 @@ Authors
 # Adapted from:
 # https://github.com/speechbrain/speechbrain/blob/v0.5.15/recipes/LibriSpeech/ASR/transducer/train.py
 
+import functools
 import itertools
 import json
 import math
 import os
 import sys
 
+import numpy as np
 import speechbrain as sb
 import torch
 import torchaudio
@@ -27,6 +29,7 @@ from hyperpyyaml import load_hyperpyyaml
 from speechbrain.dataio.sampler import DynamicBatchSampler
 from speechbrain.tokenizers.SentencePiece import SentencePiece
 from speechbrain.utils.distributed import if_main_process, run_on_main
+from torch.utils.checkpoint import checkpoint
 
 
 class TSASR(sb.Brain):
@@ -34,7 +37,7 @@ class TSASR(sb.Brain):
         """Forward computations from the waveform batches to the output probabilities."""
         current_epoch = self.hparams.epoch_counter.current
 
-        batch = batch.to(self.device)
+        batch = batch.to(self.device, non_blocking=True)
         mixed_sigs, mixed_sigs_lens = batch.mixed_sig
         tokens_bos, tokens_bos_lens = batch.tokens_bos
 
@@ -80,16 +83,36 @@ class TSASR(sb.Brain):
 
         # Forward decoder/predictor
         embs = self.modules.embedding(tokens_bos)
-        dec_out, _ = self.modules.decoder(embs, lengths=tokens_bos_lens)
+        if self.hparams.grad_ckpt and stage == sb.Stage.TRAIN:
+            dec_out, _ = checkpoint(
+                self.modules.decoder, embs, lengths=tokens_bos_lens, use_reentrant=False
+            )
+        else:
+            dec_out, _ = self.modules.decoder(embs, lengths=tokens_bos_lens)
         dec_out = self.modules.decoder_proj(dec_out)
 
         # Forward joiner
         # Add target sequence dimension to the encoder tensor: [B, T, H_enc] => [B, T, 1, H_enc]
         # Add source sequence dimension to the decoder tensor: [B, U, H_dec] => [B, 1, U, H_dec]
-        joiner_out = self.modules.joiner(enc_out[..., None, :], dec_out[:, None, ...])
-
-        # Compute transducer logits
-        logits = self.modules.transducer_head(joiner_out)
+        chunk_size = self.hparams.joiner_time_chunk
+        if chunk_size and stage == sb.Stage.TRAIN:
+            # Process the time dimension in chunks and recompute each chunk during the
+            # backward pass, so that the [B, T, U, joint_dim] joiner output is never
+            # stored in full
+            logits = torch.cat(
+                [
+                    checkpoint(
+                        self._forward_joiner,
+                        enc_out[:, i : i + chunk_size, None, :],
+                        dec_out[:, None, ...],
+                        use_reentrant=False,
+                    )
+                    for i in range(0, enc_out.shape[1], chunk_size)
+                ],
+                dim=1,
+            )
+        else:
+            logits = self._forward_joiner(enc_out[..., None, :], dec_out[:, None, ...])
 
         # Compute outputs
         hyps = None
@@ -104,6 +127,11 @@ class TSASR(sb.Brain):
 
         return logits, hyps
 
+    def _forward_joiner(self, enc_out, dec_out):
+        # Compute transducer logits
+        joiner_out = self.modules.joiner(enc_out, dec_out)
+        return self.modules.transducer_head(joiner_out)
+
     def compute_objectives(self, predictions, batch, stage):
         """Computes the transducer loss given predictions and targets."""
         logits, hyps = predictions
@@ -112,8 +140,9 @@ class TSASR(sb.Brain):
         _, mixed_sigs_lens = batch.mixed_sig
         tokens, tokens_lens = batch.tokens
 
+        # Compute the loss in full precision (logits are half precision with autocast)
         loss = self.hparams.transducer_loss(
-            logits, tokens, mixed_sigs_lens, tokens_lens
+            logits.float(), tokens, mixed_sigs_lens, tokens_lens
         )
 
         if hyps is not None:
@@ -151,6 +180,15 @@ class TSASR(sb.Brain):
         if self.hparams.enable_scheduler and should_step:
             self.hparams.noam_scheduler(self.optimizer)
 
+    def on_fit_start(self):
+        """Gets called at the beginning of ``fit()``."""
+        super().on_fit_start()
+        if self.hparams.compile_joiner:
+            # Compile the joiner together with the transducer head, so that the broadcast
+            # sum and the activation are fused instead of each materializing a
+            # [B, T, U, joint_dim] tensor
+            self._forward_joiner = torch.compile(self._forward_joiner, dynamic=True)
+
     def on_stage_start(self, stage, epoch):
         """Gets called at the beginning of each epoch."""
         if stage != sb.Stage.TRAIN:
@@ -217,61 +255,80 @@ class TSASR(sb.Brain):
                     self.wer_metric.write_stats(w)
 
 
-def dataio_prepare(hparams, tokenizer):
+def dataio_prepare(hparams, tokenizer, splits=("train", "valid", "test")):
     """This function prepares the datasets to be used in the brain class.
-    It also defines the data processing pipeline through user-defined functions."""
+    It also defines the data processing pipeline through user-defined functions.
+    Only the datasets in `splits` are created, the others are returned as None."""
 
     # 1. Define datasets
     data_folder = hparams["data_folder"]
 
-    train_data = sb.dataio.dataset.DynamicItemDataset.from_json(
-        json_path=hparams["train_json"], replacements={"DATA_ROOT": data_folder},
-    )
+    train_data = valid_data = test_data = None
+    if "train" in splits:
+        train_data = sb.dataio.dataset.DynamicItemDataset.from_json(
+            json_path=hparams["train_json"], replacements={"DATA_ROOT": data_folder},
+        )
+
+        if hparams["sorting"] == "ascending":
+            # Sort training data to speed up training
+            train_data = train_data.filtered_sorted(
+                sort_key="duration",
+                key_max_value={"duration": hparams["train_remove_if_longer"]},
+            )
 
-    if hparams["sorting"] == "ascending":
-        # Sort training data to speed up training
-        train_data = train_data.filtered_sorted(
+        elif hparams["sorting"] == "descending":
+            # Sort training data to speed up training
+            train_data = train_data.filtered_sorted(
+                sort_key="duration",
+                reverse=True,
+                key_max_value={"duration": hparams["train_remove_if_longer"]},
+            )
+
+        elif hparams["sorting"] == "random":
+            pass
+
+        else:
+            raise NotImplementedError(
+                "`sorting` must be random, ascending or descending"
+            )
+
+    if "valid" in splits:
+        valid_data = sb.dataio.dataset.DynamicItemDataset.from_json(
+            json_path=hparams["valid_json"], replacements={"DATA_ROOT": data_folder},
+        )
+        # Sort validation data to speed up validation
+        valid_data = valid_data.filtered_sorted(
             sort_key="duration",
-            key_max_value={"duration": hparams["train_remove_if_longer"]},
+            reverse=True,
+            key_max_value={"duration": hparams["valid_remove_if_longer"]},
         )
 
-    elif hparams["sorting"] == "descending":
-        # Sort training data to speed up training
-        train_data = train_data.filtered_sorted(
+    if "test" in splits:
+        test_data = sb.dataio.dataset.DynamicItemDataset.from_json(
+            json_path=hparams["test_json"], replacements={"DATA_ROOT": data_folder},
+        )
+        # Sort the test data to speed up testing
+        test_data = test_data.filtered_sorted(
             sort_key="duration",
             reverse=True,
-            key_max_value={"duration": hparams["train_remove_if_longer"]},
+            key_max_value={"duration": hparams["test_remove_if_longer"]},
         )
 
-    elif hparams["sorting"] == "random":
-        pass
-
-    else:
-        raise NotImplementedError("`sorting` must be random, ascending or descending")
-
-    valid_data = sb.dataio.dataset.DynamicItemDataset.from_json(
-        json_path=hparams["valid_json"], replacements={"DATA_ROOT": data_folder},
-    )
-    # Sort validation data to speed up validation
-    valid_data = valid_data.filtered_sorted(
-        sort_key="duration",
-        reverse=True,
-        key_max_value={"duration": hparams["valid_remove_if_longer"]},
-    )
-
-    test_data = sb.dataio.dataset.DynamicItemDataset.from_json(
-        json_path=hparams["test_json"], replacements={"DATA_ROOT": data_folder},
-    )
-    # Sort the test data to speed up testing
-    test_data = test_data.filtered_sorted(
-        sort_key="duration",
-        reverse=True,
-        key_max_value={"duration": hparams["test_remove_if_longer"]},
-    )
-
-    datasets = [train_data, valid_data, test_data]
+    datasets = [x for x in [train_data, valid_data, test_data] if x is not None]
 
     # 2. Define audio pipeline
+    resamplers = {}
+
+    def resample(sig, sample_rate):
+        # Build the resampling kernel only once for each original sample rate
+        if sample_rate == hparams["sample_rate"]:
+            return sig
+        if sample_rate not in resamplers:
+            resamplers[sample_rate] = torchaudio.transforms.Resample(
+                sample_rate, hparams["sample_rate"],
+            )
+        return resamplers[sample_rate](sig)
+
     @sb.utils.data_pipeline.takes(
         "wavs", "enroll_wav", "delays", "start", "duration", "target_speaker_idx", "id",
     )
@@ -286,9 +343,7 @@ def dataio_prepare(hparams, tokenizer):
                 sig, sample_rate = torchaudio.load(wav)
             except RuntimeError:
                 sig, sample_rate = torchaudio.load(wav.replace(".wav", ".flac"))
-            sig = torchaudio.functional.resample(
-                sig[0], sample_rate, hparams["sample_rate"],
-            )
+            sig = resample(sig[0], sample_rate)
             sigs.append(sig)
 
         tmp = []
@@ -326,9 +381,7 @@ def dataio_prepare(hparams, tokenizer):
             enroll_sig, sample_rate = torchaudio.load(
                 enroll_wav.replace(".wav", ".flac")
             )
-        enroll_sig = torchaudio.functional.resample(
-            enroll_sig[0], sample_rate, hparams["sample_rate"],
-        )
+        enroll_sig = resample(enroll_sig[0], sample_rate)
         # Trim enrollment signal if too long
         enroll_sig = enroll_sig[
             : math.ceil(hparams["trim_enroll"] * hparams["sample_rate"])
@@ -400,22 +453,27 @@ def dataio_prepare(hparams, tokenizer):
     sb.dataio.dataset.add_dynamic_item(datasets, audio_pipeline)
 
     # 3. Define text pipeline
+    # Tokenize each distinct transcription once in a single batched call
+    # (instead of once per example and epoch in the dataloader workers)
+    wrds = list({entry["wrd"] for x in datasets for entry in x.data.values()})
+    all_tokens_bos = {
+        wrd: np.array([hparams["blank_index"]] + tokens_list, dtype=np.int64)
+        for wrd, tokens_list in zip(wrds, tokenizer.sp.encode_as_ids(wrds))
+    }
+
     @sb.utils.data_pipeline.takes("wrd")
     @sb.utils.data_pipeline.provides(
         "tokens_bos", "tokens", "target_words",
     )
     def text_pipeline(wrd):
-        tokens_list = tokenizer.sp.encode_as_ids(wrd)
-        tokens_bos = torch.LongTensor([hparams["blank_index"]] + tokens_list)
+        # Zero-copy views on the precomputed token IDs
+        tokens_bos = torch.from_numpy(all_tokens_bos[wrd])
         yield tokens_bos
-        tokens = torch.LongTensor(tokens_list)
+        tokens = tokens_bos[1:]
         yield tokens
-        target_words = wrd.split(" ")
         # When `ref_tokens` is an empty string add dummy space
         # to avoid division by 0 when computing WER/CER
-        for i, char in enumerate(target_words):
-            if len(char) == 0:
-                target_words[i] = " "
+        target_words = [word if word else " " for word in wrd.split(" ")]
         yield target_words
 
     sb.dataio.dataset.add_dynamic_item(datasets, text_pipeline)
@@ -460,6 +518,8 @@ if __name__ == "__main__":
             "trim_nontarget": hparams["trim_nontarget"],
             "suppress_delay": hparams["suppress_delay"],
             "overlap_ratio": hparams["overlap_ratio"],
+            "manifest_format": hparams["manifest_format"],
+            "num_workers": hparams["prepare_num_workers"],
         },
     )
 
@@ -468,9 +528,10 @@ if __name__ == "__main__":
     train_valid_test = {}
     for split in ["train", "valid", "test"]:
         json_file = hparams[f"{split}_json"]
-        with open(json_file, encoding="utf-8") as f:
-            transcriptions = json.load(f)
-            train_valid_test.update(transcriptions)
+        transcriptions = sb.dataio.dataio.load_data_json(
+            json_file, replacements={"DATA_ROOT": hparams["data_folder"]},
+        )
+        train_valid_test.update(transcriptions)
     train_valid_test_json = os.path.join(
         os.path.dirname(json_file), "train_valid_test.json"
     )
@@ -490,12 +551,18 @@ if __name__ == "__main__":
     )
 
     # Create the datasets objects as well as tokenization and encoding
-    train_data, valid_data, _ = dataio_prepare(hparams, tokenizer)
+    train_data, valid_data, _ = dataio_prepare(
+        hparams, tokenizer, splits=["train", "valid"]
+    )
 
     # Pretrain the specified modules
     run_on_main(hparams["pretrainer"].collect_files)
     run_on_main(hparams["pretrainer"].load_collected)
 
+    # The fused AdamW step only supports CUDA parameters
+    if hparams["fused_adamw"] and "cuda" not in run_opts["device"]:
+        hparams["opt_class"] = functools.partial(hparams["opt_class"], fused=False)
+
     # Trainer initialization
     brain = TSASR(
         modules=hparams["modules"],
@@ -508,8 +575,19 @@ if __name__ == "__main__":
     # Add objects to trainer
     brain.tokenizer = tokenizer
 
+    # Keep the workers alive across epochs and prefetch pinned batches
+    # to overlap data loading and host-to-device copies with computation
+    dataloader_kwargs = {
+        "num_workers": hparams["dataloader_workers"],
+        "pin_memory": "cuda" in run_opts["device"],
+        "persistent_workers": hparams["dataloader_workers"] > 0,
+        "prefetch_factor": hparams["dataloader_prefetch_factor"]
+        if hparams["dataloader_workers"] > 0
+        else None,
+    }
+
     # Dynamic batching
-    hparams["train_dataloader_kwargs"] = {"num_workers": hparams["dataloader_workers"]}
+    hparams["train_dataloader_kwargs"] = dict(dataloader_kwargs)
     if hparams["dynamic_batching"]:
         hparams["train_dataloader_kwargs"]["batch_sampler"] = DynamicBatchSampler(
             train_data,
@@ -519,11 +597,12 @@ if __name__ == "__main__":
             shuffle=False,
             batch_ordering=hparams["sorting"],
             max_batch_ex=hparams["max_batch_size"],
+            batch_size_multiple=hparams["batch_size_multiple"],
         )
     else:
         hparams["train_dataloader_kwargs"]["batch_size"] = hparams["train_batch_size"]
 
-    hparams["valid_dataloader_kwargs"] = {"num_workers": hparams["dataloader_workers"]}
+    hparams["valid_dataloader_kwargs"] = dict(dataloader_kwargs)
     if hparams["dynamic_batching"]:
         hparams["valid_dataloader_kwargs"]["batch_sampler"] = DynamicBatchSampler(
             valid_data,
@@ -533,6 +612,7 @@ if __name__ == "__main__":
             shuffle=False,
             batch_ordering="descending",
             max_batch_ex=hparams["max_batch_size"],
+            batch_size_multiple=hparams["batch_size_multiple"],
         )
     else:
         hparams["valid_dataloader_kwargs"]["batch_size"] = hparams["valid_batch_size"]
@@ -552,30 +632,36 @@ if __name__ == "__main__":
 
         plot_grad_norm(brain.grad_norm)
 
+    # Prepare all test splits at once, writing a separate manifest for each split
+    # Due to DDP, do the preparation ONLY on the main Python process
+    run_on_main(
+        prepare_librispeechmix,
+        kwargs={
+            "data_folder": hparams["data_folder"],
+            "save_folder": hparams["save_folder"],
+            "splits": hparams["test_splits"],
+            "num_targets": hparams["num_targets"],
+            "num_enrolls": 1,
+            "trim_nontarget": hparams["trim_nontarget"],
+            "suppress_delay": hparams["suppress_delay"],
+            "overlap_ratio": hparams["overlap_ratio"],
+            "manifest_format": hparams["manifest_format"],
+            "num_workers": hparams["prepare_num_workers"],
+            "merge_splits": False,
+        },
+    )
+
     # Test on each split separately
     for split in hparams["test_splits"]:
-        # Due to DDP, do the preparation ONLY on the main Python process
-        run_on_main(
-            prepare_librispeechmix,
-            kwargs={
-                "data_folder": hparams["data_folder"],
-                "save_folder": hparams["save_folder"],
-                "splits": [split],
-                "num_targets": hparams["num_targets"],
-                "num_enrolls": 1,
-                "trim_nontarget": hparams["trim_nontarget"],
-                "suppress_delay": hparams["suppress_delay"],
-                "overlap_ratio": hparams["overlap_ratio"],
-            },
+        hparams["test_json"] = os.path.join(
+            hparams["save_folder"], f"{split}.{hparams['manifest_format']}"
         )
 
         # Create the datasets objects as well as tokenization and encoding
-        _, _, test_data = dataio_prepare(hparams, tokenizer)
+        _, _, test_data = dataio_prepare(hparams, tokenizer, splits=["test"])
 
         # Dynamic batching
-        hparams["test_dataloader_kwargs"] = {
-            "num_workers": hparams["dataloader_workers"]
-        }
+        hparams["test_dataloader_kwargs"] = dict(dataloader_kwargs)
         if hparams["dynamic_batching"]:
             hparams["test_dataloader_kwargs"]["batch_sampler"] = DynamicBatchSampler(
                 test_data,
@@ -585,6 +671,7 @@ if __name__ == "__main__":
                 shuffle=False,
                 batch_ordering="descending",
                 max_batch_ex=hparams["max_batch_size"],
+                batch_size_multiple=hparams["batch_size_multiple"],
             )
         else:
             hparams["test_dataloader_kwargs"]["batch_size"] = hparams["test_batch_size"]
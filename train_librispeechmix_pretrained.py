@@ -14,12 +14,16 @@ Authors
 # Adapted from:
 # https://github.com/speechbrain/speechbrain/blob/v0.5.15/recipes/LibriSpeech/ASR/transducer/train.py
 
+import collections
+import functools
 import itertools
 import json
 import math
 import os
 import sys
+from contextlib import nullcontext
 
+import numpy as np
 import speechbrain as sb
 import torch
 import torchaudio
@@ -28,39 +32,34 @@ from speechbrain.dataio.dataio import length_to_mask
 from speechbrain.dataio.sampler import DynamicBatchSampler
 from speechbrain.tokenizers.SentencePiece import SentencePiece
 from speechbrain.utils.distributed import if_main_process, run_on_main
+from torch.utils.checkpoint import checkpoint
 from transformers import AutoModelForAudioXVector
 
 
 class TSASR(sb.Brain):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.speaker_embs_cache = collections.OrderedDict()
+
     def compute_forward(self, batch, stage):
         """Forward computations from the waveform batches to the output probabilities."""
         current_epoch = self.hparams.epoch_counter.current
 
-        batch = batch.to(self.device)
+        batch = batch.to(self.device, non_blocking=True)
         mixed_sigs, mixed_sigs_lens = batch.mixed_sig
         enroll_sigs, enroll_sigs_lens = batch.enroll_sig
         tokens_bos, tokens_bos_lens = batch.tokens_bos
 
         # Extract speaker embedding
-        with torch.no_grad():
-            self.modules.speaker_encoder.eval()
-            speaker_embs = self.modules.speaker_encoder(
-                input_values=enroll_sigs,
-                attention_mask=length_to_mask(
-                    (enroll_sigs_lens * enroll_sigs.shape[-1])
-                    .ceil()
-                    .clamp(max=enroll_sigs.shape[-1])
-                    .int()
-                ).long(),  # 0 for masked tokens
-                output_attentions=False,
-                output_hidden_states=self.hparams.injection_mode == "cross_attention",
+        if (
+            self.hparams.speaker_embs_cache_size
+            and self.hparams.injection_mode != "cross_attention"
+        ):
+            speaker_embs = self._cached_speaker_embs(
+                batch.enroll_wav, enroll_sigs, enroll_sigs_lens
             )
-        if self.hparams.injection_mode == "cross_attention":
-            speaker_embs = speaker_embs.hidden_states[-1][
-                ..., : self.hparams.speaker_embedding_dim
-            ]
         else:
-            speaker_embs = speaker_embs.embeddings[:, None, :]
+            speaker_embs = self._compute_speaker_embs(enroll_sigs, enroll_sigs_lens)
         if hparams["plot_embeddings"]:
             # Collect speaker embeddings
             for i, (ID, speaker_emb) in enumerate(zip(batch.id, speaker_embs)):
@@ -122,16 +121,36 @@ class TSASR(sb.Brain):
 
         # Forward decoder/predictor
         embs = self.modules.embedding(tokens_bos)
-        dec_out, _ = self.modules.decoder(embs, lengths=tokens_bos_lens)
+        if self.hparams.grad_ckpt and stage == sb.Stage.TRAIN:
+            dec_out, _ = checkpoint(
+                self.modules.decoder, embs, lengths=tokens_bos_lens, use_reentrant=False
+            )
+        else:
+            dec_out, _ = self.modules.decoder(embs, lengths=tokens_bos_lens)
         dec_out = self.modules.decoder_proj(dec_out)
 
         # Forward joiner
         # Add target sequence dimension to the encoder tensor: [B, T, H_enc] => [B, T, 1, H_enc]
         # Add source sequence dimension to the decoder tensor: [B, U, H_dec] => [B, 1, U, H_dec]
-        joiner_out = self.modules.joiner(enc_out[..., None, :], dec_out[:, None, ...])
-
-        # Compute transducer logits
-        logits = self.modules.transducer_head(joiner_out)
+        chunk_size = self.hparams.joiner_time_chunk
+        if chunk_size and stage == sb.Stage.TRAIN:
+            # Process the time dimension in chunks and recompute each chunk during the
+            # backward pass, so that the [B, T, U, joint_dim] joiner output is never
+            # stored in full
+            logits = torch.cat(
+                [
+                    checkpoint(
+                        self._forward_joiner,
+                        enc_out[:, i : i + chunk_size, None, :],
+                        dec_out[:, None, ...],
+                        use_reentrant=False,
+                    )
+                    for i in range(0, enc_out.shape[1], chunk_size)
+                ],
+                dim=1,
+            )
+        else:
+            logits = self._forward_joiner(enc_out[..., None, :], dec_out[:, None, ...])
 
         # Compute outputs
         hyps = None
@@ -146,6 +165,68 @@ class TSASR(sb.Brain):
 
         return logits, hyps
 
+    def _compute_speaker_embs(self, enroll_sigs, enroll_sigs_lens):
+        # The speaker encoder is frozen, so it can optionally run in half precision
+        if self.hparams.speaker_encoder_precision == "fp32":
+            autocast = nullcontext()
+        else:
+            autocast = torch.autocast(
+                device_type=torch.device(self.device).type,
+                dtype={"fp16": torch.float16, "bf16": torch.bfloat16}[
+                    self.hparams.speaker_encoder_precision
+                ],
+            )
+        with torch.inference_mode(), autocast:
+            self.modules.speaker_encoder.eval()
+            speaker_embs = self.modules.speaker_encoder(
+                input_values=enroll_sigs,
+                attention_mask=length_to_mask(
+                    (enroll_sigs_lens * enroll_sigs.shape[-1])
+                    .ceil()
+                    .clamp(max=enroll_sigs.shape[-1]),
+                    max_len=enroll_sigs.shape[-1],
+                    dtype=torch.long,
+                ),  # 0 for masked tokens
+                output_attentions=False,
+                output_hidden_states=self.hparams.injection_mode == "cross_attention",
+            )
+        if self.hparams.injection_mode == "cross_attention":
+            speaker_embs = speaker_embs.hidden_states[-1][
+                ..., : self.hparams.speaker_embedding_dim
+            ]
+        else:
+            speaker_embs = speaker_embs.embeddings[:, None, :]
+        # Inference tensors cannot be saved for backward (e.g. by the speaker projection),
+        # so copy the embeddings into a regular tensor
+        speaker_embs = speaker_embs.to(torch.float32, copy=True)
+        return speaker_embs
+
+    def _cached_speaker_embs(self, enroll_wavs, enroll_sigs, enroll_sigs_lens):
+        # The speaker encoder is frozen, so the embedding of each enrollment utterance
+        # can be computed once and reused. Embeddings are kept on the CPU in an LRU
+        # cache and the speaker encoder only runs on the cache misses
+        cache = self.speaker_embs_cache
+        misses = [
+            i for i, enroll_wav in enumerate(enroll_wavs) if enroll_wav not in cache
+        ]
+        if misses:
+            speaker_embs = self._compute_speaker_embs(
+                enroll_sigs[misses], enroll_sigs_lens[misses]
+            )
+            for i, speaker_emb in zip(misses, speaker_embs.cpu()):
+                cache[enroll_wavs[i]] = speaker_emb
+        for enroll_wav in enroll_wavs:
+            cache.move_to_end(enroll_wav)
+        speaker_embs = torch.stack([cache[x] for x in enroll_wavs])
+        while len(cache) > self.hparams.speaker_embs_cache_size:
+            cache.popitem(last=False)
+        return speaker_embs.to(self.device, non_blocking=True)
+
+    def _forward_joiner(self, enc_out, dec_out):
+        # Compute transducer logits
+        joiner_out = self.modules.joiner(enc_out, dec_out)
+        return self.modules.transducer_head(joiner_out)
+
     def compute_objectives(self, predictions, batch, stage):
         """Computes the transducer loss given predictions and targets."""
         logits, hyps = predictions
@@ -154,8 +235,9 @@ class TSASR(sb.Brain):
         _, mixed_sigs_lens = batch.mixed_sig
         tokens, tokens_lens = batch.tokens
 
+        # Compute the loss in full precision (logits are half precision with autocast)
         loss = self.hparams.transducer_loss(
-            logits, tokens, mixed_sigs_lens, tokens_lens
+            logits.float(), tokens, mixed_sigs_lens, tokens_lens
         )
 
         if hyps is not None:
@@ -193,6 +275,15 @@ class TSASR(sb.Brain):
         if self.hparams.enable_scheduler and should_step:
             self.hparams.noam_scheduler(self.optimizer)
 
+    def on_fit_start(self):
+        """Gets called at the beginning of ``fit()``."""
+        super().on_fit_start()
+        if self.hparams.compile_joiner:
+            # Compile the joiner together with the transducer head, so that the broadcast
+            # sum and the activation are fused instead of each materializing a
+            # [B, T, U, joint_dim] tensor
+            self._forward_joiner = torch.compile(self._forward_joiner, dynamic=True)
+
     def on_stage_start(self, stage, epoch):
         """Gets called at the beginning of each epoch."""
         if stage != sb.Stage.TRAIN:
@@ -275,61 +366,80 @@ class TSASR(sb.Brain):
                 )
 
 
-def dataio_prepare(hparams, tokenizer):
+def dataio_prepare(hparams, tokenizer, splits=("train", "valid", "test")):
     """This function prepares the datasets to be used in the brain class.
-    It also defines the data processing pipeline through user-defined functions."""
+    It also defines the data processing pipeline through user-defined functions.
+    Only the datasets in `splits` are created, the others are returned as None."""
 
     # 1. Define datasets
     data_folder = hparams["data_folder"]
 
-    train_data = sb.dataio.dataset.DynamicItemDataset.from_json(
-        json_path=hparams["train_json"], replacements={"DATA_ROOT": data_folder},
-    )
+    train_data = valid_data = test_data = None
+    if "train" in splits:
+        train_data = sb.dataio.dataset.DynamicItemDataset.from_json(
+            json_path=hparams["train_json"], replacements={"DATA_ROOT": data_folder},
+        )
+
+        if hparams["sorting"] == "ascending":
+            # Sort training data to speed up training
+            train_data = train_data.filtered_sorted(
+                sort_key="duration",
+                key_max_value={"duration": hparams["train_remove_if_longer"]},
+            )
+
+        elif hparams["sorting"] == "descending":
+            # Sort training data to speed up training
+            train_data = train_data.filtered_sorted(
+                sort_key="duration",
+                reverse=True,
+                key_max_value={"duration": hparams["train_remove_if_longer"]},
+            )
+
+        elif hparams["sorting"] == "random":
+            pass
 
-    if hparams["sorting"] == "ascending":
-        # Sort training data to speed up training
-        train_data = train_data.filtered_sorted(
+        else:
+            raise NotImplementedError(
+                "`sorting` must be random, ascending or descending"
+            )
+
+    if "valid" in splits:
+        valid_data = sb.dataio.dataset.DynamicItemDataset.from_json(
+            json_path=hparams["valid_json"], replacements={"DATA_ROOT": data_folder},
+        )
+        # Sort validation data to speed up validation
+        valid_data = valid_data.filtered_sorted(
             sort_key="duration",
-            key_max_value={"duration": hparams["train_remove_if_longer"]},
+            reverse=True,
+            key_max_value={"duration": hparams["valid_remove_if_longer"]},
         )
 
-    elif hparams["sorting"] == "descending":
-        # Sort training data to speed up training
-        train_data = train_data.filtered_sorted(
+    if "test" in splits:
+        test_data = sb.dataio.dataset.DynamicItemDataset.from_json(
+            json_path=hparams["test_json"], replacements={"DATA_ROOT": data_folder},
+        )
+        # Sort the test data to speed up testing
+        test_data = test_data.filtered_sorted(
             sort_key="duration",
             reverse=True,
-            key_max_value={"duration": hparams["train_remove_if_longer"]},
+            key_max_value={"duration": hparams["test_remove_if_longer"]},
         )
 
-    elif hparams["sorting"] == "random":
-        pass
-
-    else:
-        raise NotImplementedError("`sorting` must be random, ascending or descending")
-
-    valid_data = sb.dataio.dataset.DynamicItemDataset.from_json(
-        json_path=hparams["valid_json"], replacements={"DATA_ROOT": data_folder},
-    )
-    # Sort validation data to speed up validation
-    valid_data = valid_data.filtered_sorted(
-        sort_key="duration",
-        reverse=True,
-        key_max_value={"duration": hparams["valid_remove_if_longer"]},
-    )
-
-    test_data = sb.dataio.dataset.DynamicItemDataset.from_json(
-        json_path=hparams["test_json"], replacements={"DATA_ROOT": data_folder},
-    )
-    # Sort the test data to speed up testing
-    test_data = test_data.filtered_sorted(
-        sort_key="duration",
-        reverse=True,
-        key_max_value={"duration": hparams["test_remove_if_longer"]},
-    )
-
-    datasets = [train_data, valid_data, test_data]
+    datasets = [x for x in [train_data, valid_data, test_data] if x is not None]
 
     # 2. Define audio pipeline
+    resamplers = {}
+
+    def resample(sig, sample_rate):
+        # Build the resampling kernel only once for each original sample rate
+        if sample_rate == hparams["sample_rate"]:
+            return sig
+        if sample_rate not in resamplers:
+            resamplers[sample_rate] = torchaudio.transforms.Resample(
+                sample_rate, hparams["sample_rate"],
+            )
+        return resamplers[sample_rate](sig)
+
     @sb.utils.data_pipeline.takes(
         "wavs", "enroll_wav", "delays", "start", "duration", "target_speaker_idx", "id",
     )
@@ -344,9 +454,7 @@ def dataio_prepare(hparams, tokenizer):
                 sig, sample_rate = torchaudio.load(wav)
             except RuntimeError:
                 sig, sample_rate = torchaudio.load(wav.replace(".wav", ".flac"))
-            sig = torchaudio.functional.resample(
-                sig[0], sample_rate, hparams["sample_rate"],
-            )
+            sig = resample(sig[0], sample_rate)
             sigs.append(sig)
 
         tmp = []
@@ -384,9 +492,7 @@ def dataio_prepare(hparams, tokenizer):
             enroll_sig, sample_rate = torchaudio.load(
                 enroll_wav.replace(".wav", ".flac")
             )
-        enroll_sig = torchaudio.functional.resample(
-            enroll_sig[0], sample_rate, hparams["sample_rate"],
-        )
+        enroll_sig = resample(enroll_sig[0], sample_rate)
         # Trim enrollment signal if too long
         enroll_sig = enroll_sig[
             : math.ceil(hparams["trim_enroll"] * hparams["sample_rate"])
@@ -458,22 +564,27 @@ def dataio_prepare(hparams, tokenizer):
     sb.dataio.dataset.add_dynamic_item(datasets, audio_pipeline)
 
     # 3. Define text pipeline
+    # Tokenize each distinct transcription once in a single batched call
+    # (instead of once per example and epoch in the dataloader workers)
+    wrds = list({entry["wrd"] for x in datasets for entry in x.data.values()})
+    all_tokens_bos = {
+        wrd: np.array([hparams["blank_index"]] + tokens_list, dtype=np.int64)
+        for wrd, tokens_list in zip(wrds, tokenizer.sp.encode_as_ids(wrds))
+    }
+
     @sb.utils.data_pipeline.takes("wrd")
     @sb.utils.data_pipeline.provides(
         "tokens_bos", "tokens", "target_words",
     )
     def text_pipeline(wrd):
-        tokens_list = tokenizer.sp.encode_as_ids(wrd)
-        tokens_bos = torch.LongTensor([hparams["blank_index"]] + tokens_list)
+        # Zero-copy views on the precomputed token IDs
+        tokens_bos = torch.from_numpy(all_tokens_bos[wrd])
         yield tokens_bos
-        tokens = torch.LongTensor(tokens_list)
+        tokens = tokens_bos[1:]
         yield tokens
-        target_words = wrd.split(" ")
         # When `ref_tokens` is an empty string add dummy space
         # to avoid division by 0 when computing WER/CER
-        for i, char in enumerate(target_words):
-            if len(char) == 0:
-                target_words[i] = " "
+        target_words = [word if word else " " for word in wrd.split(" ")]
         yield target_words
 
     sb.dataio.dataset.add_dynamic_item(datasets, text_pipeline)
@@ -481,7 +592,15 @@ def dataio_prepare(hparams, tokenizer):
     # 4. Set output
     sb.dataio.dataset.set_output_keys(
         datasets,
-        ["id", "mixed_sig", "enroll_sig", "tokens_bos", "tokens", "target_words"],
+        [
+            "id",
+            "mixed_sig",
+            "enroll_sig",
+            "enroll_wav",
+            "tokens_bos",
+            "tokens",
+            "target_words",
+        ],
     )
 
     return train_data, valid_data, test_data
@@ -518,6 +637,8 @@ if __name__ == "__main__":
             "trim_nontarget": hparams["trim_nontarget"],
             "suppress_delay": hparams["suppress_delay"],
             "overlap_ratio": hparams["overlap_ratio"],
+            "manifest_format": hparams["manifest_format"],
+            "num_workers": hparams["prepare_num_workers"],
         },
     )
 
@@ -526,9 +647,10 @@ if __name__ == "__main__":
     train_valid_test = {}
     for split in ["train", "valid", "test"]:
         json_file = hparams[f"{split}_json"]
-        with open(json_file, encoding="utf-8") as f:
-            transcriptions = json.load(f)
-            train_valid_test.update(transcriptions)
+        transcriptions = sb.dataio.dataio.load_data_json(
+            json_file, replacements={"DATA_ROOT": hparams["data_folder"]},
+        )
+        train_valid_test.update(transcriptions)
     train_valid_test_json = os.path.join(
         os.path.dirname(json_file), "train_valid_test.json"
     )
@@ -548,7 +670,9 @@ if __name__ == "__main__":
     )
 
     # Create the datasets objects as well as tokenization and encoding
-    train_data, valid_data, _ = dataio_prepare(hparams, tokenizer)
+    train_data, valid_data, _ = dataio_prepare(
+        hparams, tokenizer, splits=["train", "valid"]
+    )
 
     # Pretrain the specified modules
     run_on_main(hparams["pretrainer"].collect_files)
@@ -565,6 +689,10 @@ if __name__ == "__main__":
         f"{round(sum([x.numel() for x in speaker_encoder.parameters()]) / 1e6)}M parameters in frozen speaker encoder"
     )
 
+    # The fused AdamW step only supports CUDA parameters
+    if hparams["fused_adamw"] and "cuda" not in run_opts["device"]:
+        hparams["opt_class"] = functools.partial(hparams["opt_class"], fused=False)
+
     # Trainer initialization
     brain = TSASR(
         modules=hparams["modules"],
@@ -577,8 +705,19 @@ if __name__ == "__main__":
     # Add objects to trainer
     brain.tokenizer = tokenizer
 
+    # Keep the workers alive across epochs and prefetch pinned batches
+    # to overlap data loading and host-to-device copies with computation
+    dataloader_kwargs = {
+        "num_workers": hparams["dataloader_workers"],
+        "pin_memory": "cuda" in run_opts["device"],
+        "persistent_workers": hparams["dataloader_workers"] > 0,
+        "prefetch_factor": hparams["dataloader_prefetch_factor"]
+        if hparams["dataloader_workers"] > 0
+        else None,
+    }
+
     # Dynamic batching
-    hparams["train_dataloader_kwargs"] = {"num_workers": hparams["dataloader_workers"]}
+    hparams["train_dataloader_kwargs"] = dict(dataloader_kwargs)
     if hparams["dynamic_batching"]:
         hparams["train_dataloader_kwargs"]["batch_sampler"] = DynamicBatchSampler(
             train_data,
@@ -588,11 +727,12 @@ if __name__ == "__main__":
             shuffle=False,
             batch_ordering=hparams["sorting"],
             max_batch_ex=hparams["max_batch_size"],
+            batch_size_multiple=hparams["batch_size_multiple"],
         )
     else:
         hparams["train_dataloader_kwargs"]["batch_size"] = hparams["train_batch_size"]
 
-    hparams["valid_dataloader_kwargs"] = {"num_workers": hparams["dataloader_workers"]}
+    hparams["valid_dataloader_kwargs"] = dict(dataloader_kwargs)
     if hparams["dynamic_batching"]:
         hparams["valid_dataloader_kwargs"]["batch_sampler"] = DynamicBatchSampler(
             valid_data,
@@ -602,6 +742,7 @@ if __name__ == "__main__":
             shuffle=False,
             batch_ordering="descending",
             max_batch_ex=hparams["max_batch_size"],
+            batch_size_multiple=hparams["batch_size_multiple"],
         )
     else:
         hparams["valid_dataloader_kwargs"]["batch_size"] = hparams["valid_batch_size"]
@@ -621,30 +762,36 @@ if __name__ == "__main__":
 
         plot_grad_norm(brain.grad_norm)
 
+    # Prepare all test splits at once, writing a separate manifest for each split
+    # Due to DDP, do the preparation ONLY on the main Python process
+    run_on_main(
+        prepare_librispeechmix,
+        kwargs={
+            "data_folder": hparams["data_folder"],
+            "save_folder": hparams["save_folder"],
+            "splits": hparams["test_splits"],
+            "num_targets": hparams["num_targets"],
+            "num_enrolls": hparams["num_enrolls"],
+            "trim_nontarget": hparams["trim_nontarget"],
+            "suppress_delay": hparams["suppress_delay"],
+            "overlap_ratio": hparams["overlap_ratio"],
+            "manifest_format": hparams["manifest_format"],
+            "num_workers": hparams["prepare_num_workers"],
+            "merge_splits": False,
+        },
+    )
+
     # Test on each split separately
     for split in hparams["test_splits"]:
-        # Due to DDP, do the preparation ONLY on the main Python process
-        run_on_main(
-            prepare_librispeechmix,
-            kwargs={
-                "data_folder": hparams["data_folder"],
-                "save_folder": hparams["save_folder"],
-                "splits": [split],
-                "num_targets": hparams["num_targets"],
-                "num_enrolls": hparams["num_enrolls"],
-                "trim_nontarget": hparams["trim_nontarget"],
-                "suppress_delay": hparams["suppress_delay"],
-                "overlap_ratio": hparams["overlap_ratio"],
-            },
+        hparams["test_json"] = os.path.join(
+            hparams["save_folder"], f"{split}.{hparams['manifest_format']}"
         )
 
         # Create the datasets objects as well as tokenization and encoding
-        _, _, test_data = dataio_prepare(hparams, tokenizer)
+        _, _, test_data = dataio_prepare(hparams, tokenizer, splits=["test"])
 
         # Dynamic batching
-        hparams["test_dataloader_kwargs"] = {
-            "num_workers": hparams["dataloader_workers"]
-        }
+        hparams["test_dataloader_kwargs"] = dict(dataloader_kwargs)
         if hparams["dynamic_batching"]:
             hparams["test_dataloader_kwargs"]["batch_sampler"] = DynamicBatchSampler(
                 test_data,
@@ -654,6 +801,7 @@ if __name__ == "__main__":
                 shuffle=False,
                 batch_ordering="descending",
                 max_batch_ex=hparams["max_batch_size"],
+                batch_size_multiple=hparams["batch_size_multiple"],
             )
         else:
             hparams["test_dataloader_kwargs"]["batch_size"] = hparams["test_batch_size"]